@@ -1,20 +1,28 @@
 #this script saves the scaler and kmeans cluster files to be used in the final project
 #merged_data.csv is used here again, file path may need to be changed for it to work.
 
+# Use oneDAL accelerated scikit-learn kernels when scikit-learn-intelex is installed (Intel CPUs)
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
+
 import pandas as pd
 import numpy as np
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 from joblib import dump
 from sklearn.model_selection import train_test_split
 
-# Load dataset
-df = pd.read_csv("../merged_file.csv")
+# Load only the feature columns, as float32
+FEATURES = ['A', 'VA', 'W', 'V', 'PF']
+df = pd.read_csv("../merged_file.csv", usecols=FEATURES, dtype={col: np.float32 for col in FEATURES})
 df.ffill(inplace=True)
 
 # Select features for scaling and PCA
-X = df[['A', 'VA', 'W', 'V', 'PF']]
+X = df[FEATURES]
 
 # Train-test split (full data for feature extraction and scaling)
 X_train_full, X_test = train_test_split(X, test_size=0.2, random_state=42)
@@ -38,12 +46,16 @@ dump(pca, "pca_model.joblib")
 print("PCA model saved as 'pca_model.joblib'.")
 
 # ----- Apply KMeans Clustering -----
-kmeans = KMeans(n_clusters=9, random_state=42)  # Set the number of clusters to 9
-kmeans.fit(X_train_pca)  # Fit KMeans on the PCA-reduced training data
+kmeans = MiniBatchKMeans(n_clusters=9, random_state=42, batch_size=4096, n_init='auto')  # Set the number of clusters to 9
+kmeans.fit(X_train_pca.astype(np.float32))  # Fit KMeans on the PCA-reduced training data
 
 # Save the KMeans model
 dump(kmeans, "kmeans_model.joblib")
 print("KMeans model saved as 'kmeans_model.joblib'.")
 
+# Save the cluster centers on their own so send_data.py can memory-map them
+np.save("kmeans_centers.npy", kmeans.cluster_centers_.astype(np.float32))
+print("KMeans cluster centers saved as 'kmeans_centers.npy'.")
+
 # OPTIONAL: You can check the cluster centers to verify the results
 print(f"Cluster centers: {kmeans.cluster_centers_}")
@@ -1,32 +1,61 @@
-# THis script has used the file merged_data.csv to train out randon forest model with multioutputclassifier
+# THis script has used the file merged_data.csv to train out randon forest model on all labels at once (multi-output)
 #it uses optuna library to automate hyperparameter tuning
 #the file path may need to be changed for this to work as it is
 
+# Use oneDAL accelerated scikit-learn kernels when scikit-learn-intelex is installed (Intel CPUs)
+try:
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+except ImportError:
+    pass
+
+import os
+import threading
 import pandas as pd
 import numpy as np
 import optuna
+from optuna.study import MaxTrialsCallback
+from optuna.trial import TrialState
 from sklearn.model_selection import train_test_split
 from sklearn.ensemble import RandomForestClassifier
-from sklearn.multioutput import MultiOutputClassifier
 from sklearn.metrics import accuracy_score
 from joblib import dump
+import onnxruntime
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
 from tqdm import tqdm
 
-# Load dataset
-df = pd.read_csv("../merged_file.csv")
+# Load only the feature and label columns (labels start at column 8), as float32
+DATA_PATH = "../merged_file.csv"
+FEATURES = ['A', 'VA', 'W', 'V', 'PF']
+LABELS = list(pd.read_csv(DATA_PATH, nrows=0).columns[8:])
+df = pd.read_csv(DATA_PATH, usecols=FEATURES + LABELS, dtype={col: np.float32 for col in FEATURES + LABELS})
 df.ffill(inplace=True)
 
 # Select features and labels
-X = df[['A', 'VA', 'W', 'V', 'PF']]
-y = df.iloc[:, 8:].astype(int)
+X = df[FEATURES]
+y = df[LABELS].astype(np.int8)  # Labels are small integers
+
+# A label column can be constant (e.g. an appliance that is always on). A single multi-output
+# forest fits and predicts such columns fine, but per-output scores like oob_score_ cannot be used
+constant_labels = [col for col in LABELS if y[col].nunique() < 2]
+if constant_labels:
+    print(f"Constant label columns (single class): {constant_labels}")
 
 # Train-test split (full data)
 X_train_full, X_test, y_train_full, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
-# Subsample training data for tuning
-X_train_sample, _, y_train_sample, _ = train_test_split(X_train_full, y_train_full, test_size=0.8, random_state=42)
+# Subsample 20% of the training data for tuning
+sample_idx = np.random.default_rng(42).choice(len(X_train_full), size=int(0.2 * len(X_train_full)), replace=False)
+X_train_sample = X_train_full.iloc[sample_idx]
+y_train_sample = y_train_full.iloc[sample_idx]
+
+# Hold out the last quarter of the (already shuffled) sample to score trials on unseen rows
+n_tune_fit = int(0.75 * len(sample_idx))
+X_tune_fit, X_tune_val = X_train_sample.iloc[:n_tune_fit], X_train_sample.iloc[n_tune_fit:]
+y_tune_fit, y_tune_val = y_train_sample.iloc[:n_tune_fit], y_train_sample.iloc[n_tune_fit:]
 
-print(f"Sampled {X_train_sample.shape[0]} samples for Optuna tuning.")
+print(f"Sampled {X_train_sample.shape[0]} samples for Optuna tuning ({len(X_tune_val)} held out for scoring).")
 
 # Define objective function for Optuna
 def objective(trial):
@@ -36,36 +65,49 @@ def objective(trial):
     min_samples_leaf = trial.suggest_int('min_samples_leaf', 1, 10)
     max_features = trial.suggest_categorical('max_features', ['sqrt', 'log2', 1, 2, 3])
     
-    rf = RandomForestClassifier(
+    # RandomForestClassifier fits all label columns with one shared set of trees
+    model = RandomForestClassifier(
         n_estimators=n_estimators,
         max_depth=max_depth,
         min_samples_split=min_samples_split,
         min_samples_leaf=min_samples_leaf,
         max_features=max_features,
-        n_jobs=-1,
+        n_jobs=1,  # Trials already run in parallel, avoid oversubscribing cores
         random_state=42
     )
     
-    model = MultiOutputClassifier(rf)
-    model.fit(X_train_sample, y_train_sample)
+    model.fit(X_tune_fit, y_tune_fit.values)
     
-    preds = model.predict(X_train_sample)
-    score = accuracy_score(y_train_sample, preds)
+    # Holdout accuracy rather than oob_score_, which fails when a label column is constant
+    preds = model.predict(X_tune_val)
+    score = accuracy_score(y_tune_val, preds)
     
     return score
 
-# Create Optuna study
-study = optuna.create_study(direction='maximize')
+# Create Optuna study backed by SQLite so several processes can share trials.
+# Change the study name whenever the objective changes, scores from different objectives are not comparable
+storage = optuna.storages.RDBStorage("sqlite:///tune.db")
+study = optuna.create_study(direction='maximize', storage=storage, study_name='rf_holdout', load_if_exists=True)
 
 # Custom loop with tqdm progress bar
-N_TRIALS = 20  # You can later increase this safely
+N_TRIALS = 20  # Total trials for the study, re-runs only finish the remaining ones
+N_JOBS = max(1, (os.cpu_count() or 2) // 2)  # Parallel trials
 
-print("Starting Optuna optimization with progress bar...")
-with tqdm(total=N_TRIALS) as pbar:
+completed_trials = len(study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,)))
+remaining_trials = max(0, N_TRIALS - completed_trials)
+
+print(f"Starting Optuna optimization with progress bar ({N_JOBS} parallel trials, "
+      f"{completed_trials} of {N_TRIALS} already completed)...")
+pbar_lock = threading.Lock()
+with tqdm(total=remaining_trials) as pbar:
     def callback(study, trial):
-        pbar.update(1)
+        with pbar_lock:
+            pbar.update(1)
 
-    study.optimize(objective, n_trials=N_TRIALS, callbacks=[callback])
+    if remaining_trials > 0:
+        # MaxTrialsCallback stops this process once other workers sharing tune.db have completed the budget
+        study.optimize(objective, n_trials=remaining_trials, n_jobs=N_JOBS,
+                       callbacks=[callback, MaxTrialsCallback(N_TRIALS, states=(TrialState.COMPLETE,))])
 
 print("Optimization completed.")
 
@@ -75,7 +117,7 @@ print(study.best_params)
 # Train final model on FULL training data using best params
 best_params = study.best_params
 
-final_rf = RandomForestClassifier(
+final_model = RandomForestClassifier(
     n_estimators=best_params['n_estimators'],
     max_depth=best_params['max_depth'],
     min_samples_split=best_params['min_samples_split'],
@@ -85,14 +127,33 @@ final_rf = RandomForestClassifier(
     random_state=42
 )
 
-final_model = MultiOutputClassifier(final_rf)
-final_model.fit(X_train_full, y_train_full)
+final_model.fit(X_train_full, y_train_full.values)
 
 # Evaluate final model
 y_pred = final_model.predict(X_test)
 final_accuracy = accuracy_score(y_test, y_pred)
 print(f"Final Test Accuracy: {final_accuracy:.2f}")
 
+# Inference runs on single samples, persist the model without joblib parallelism
+final_model.n_jobs = 1
+
 # Save final optimized model
 dump(final_model, "optimized_random_forest_optuna_rpi.joblib", compress=3)
 print("Optimized model saved as 'optimized_random_forest_optuna_rpi.joblib'.")
+
+# Export to ONNX for faster inference with onnxruntime on the device
+# ZipMap has to be off, it cannot handle the 2-D label output of a multi-output forest
+onx = convert_sklearn(final_model, initial_types=[('input', FloatTensorType([None, X.shape[1]]))],
+                      options={id(final_model): {'zipmap': False}})
+
+# Only ship the ONNX model if onnxruntime loads it and reproduces the sklearn predictions
+session = onnxruntime.InferenceSession(onx.SerializeToString(), providers=["CPUExecutionProvider"])
+onnx_pred = session.run([session.get_outputs()[0].name],
+                        {session.get_inputs()[0].name: X_test.to_numpy(dtype=np.float32)})[0]
+if np.array_equal(onnx_pred, y_pred):
+    with open("optimized_random_forest_optuna_rpi.onnx", "wb") as f:
+        f.write(onx.SerializeToString())
+    print("ONNX model saved as 'optimized_random_forest_optuna_rpi.onnx'.")
+else:
+    mismatch = np.mean(np.any(onnx_pred != y_pred, axis=1))
+    print(f"ONNX predictions differ from sklearn on {mismatch:.2%} of test rows, ONNX model not saved.")
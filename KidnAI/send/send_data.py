@@ -17,34 +17,101 @@ import numpy as np
 import random
 import time
 import json
+import orjson
 import os
+import sys
 import warnings
 import asyncio
+from dataclasses import dataclass
+import onnxruntime
+from numba import njit
 from azure.iot.device import IoTHubDeviceClient, Message
 from azure.iot.device.exceptions import ConnectionFailedError, ConnectionDroppedError
-from scipy.spatial.distance import jensenshannon
+from scipy.special import rel_entr
 
 warnings.filterwarnings("ignore")
 
 # ---------- Load Configuration ----------
-with open("config.json", "r") as f:
-    config = json.load(f)
+# Immutable view of config.json, slotted where supported (slots= needs Python 3.10,
+# Raspberry Pi OS Bullseye ships 3.9)
+@dataclass(frozen=True, **({"slots": True} if sys.version_info >= (3, 10) else {}))
+class Config:
+    azure_connection_string: str
+    device_id: str
+    message_property_topic: str
+    alert_property_topic: str
+    rf_model_path: str
+    scaler_path: str
+    pca_path: str
+    cluster_model_path: str
+    # Optional artifacts, older config.json files without these keys keep working
+    rf_onnx_path: str = "models/optimized_random_forest_optuna_rpi.onnx"
+    cluster_centers_path: str = "models/kmeans_centers.npy"
 
-AZURE_CONNECTION_STRING = config["azure_connection_string"]
-DEVICE_ID = config["device_id"]
-MESSAGE_TOPIC = config["message_property_topic"]
-ALERT_TOPIC = config["alert_property_topic"]
-RF_MODEL_PATH = config["rf_model_path"]
-SCALER_PATH = config["scaler_path"]
-PCA_PATH = config["pca_path"]
-CLUSTER_PATH = config["cluster_model_path"]
+with open("config.json", "r") as f:
+    CFG = Config(**json.load(f))
 
 # ---------- Load Models ----------
-#dt_model = joblib.load(DT_MODEL_PATH)
-rf_model = joblib.load(RF_MODEL_PATH)
-scaler = joblib.load(SCALER_PATH)
-pca = joblib.load(PCA_PATH)
-kmeans = joblib.load(CLUSTER_PATH)
+_loaded_models = {}
+
+def load_model(path):
+    """Load a joblib artifact once per process and reuse it on later calls"""
+    if path not in _loaded_models:
+        _loaded_models[path] = joblib.load(path)
+    return _loaded_models[path]
+
+#dt_model = load_model(DT_MODEL_PATH)
+# Prefer the ONNX export of the random forest, fall back to the scikit-learn model
+# if it is missing or onnxruntime cannot load it
+rf_session = None
+if os.path.exists(CFG.rf_onnx_path):
+    try:
+        sess_options = onnxruntime.SessionOptions()
+        sess_options.intra_op_num_threads = 1  # Single-sample batches, threading only adds overhead
+        rf_session = onnxruntime.InferenceSession(CFG.rf_onnx_path, sess_options, providers=["CPUExecutionProvider"])
+        RF_ONNX_INPUT = rf_session.get_inputs()[0].name
+        RF_ONNX_LABEL = rf_session.get_outputs()[0].name
+    except Exception as e:
+        print(f"[MODEL] Failed to load ONNX model, falling back to joblib model: {e}")
+        rf_session = None
+
+if rf_session is not None:
+    rf_model = None
+else:
+    # Not memory-mapped: sklearn copies the tree node arrays into its own buffers on unpickling
+    rf_model = load_model(CFG.rf_model_path)
+    # Predictions are single samples, joblib thread dispatch costs more than the tree traversal
+    rf_model.n_jobs = 1
+    # Older artifacts wrap one forest per label in a MultiOutputClassifier
+    from sklearn.multioutput import MultiOutputClassifier
+    if isinstance(rf_model, MultiOutputClassifier):
+        for est in rf_model.estimators_:
+            est.n_jobs = 1
+scaler = load_model(CFG.scaler_path)
+pca = load_model(CFG.pca_path)
+
+# Scaler and PCA folded into one float32 affine transform for the hot path
+SCALER_MEAN = scaler.mean_.astype(np.float32)
+SCALER_INV_SCALE = (1.0 / scaler.scale_).astype(np.float32)
+PCA_MEAN = pca.mean_.astype(np.float32)
+PCA_WEIGHTS = pca.components_.T
+if pca.whiten:
+    PCA_WEIGHTS = PCA_WEIGHTS / np.sqrt(pca.explained_variance_)
+PCA_WEIGHTS = PCA_WEIGHTS.astype(np.float32)
+
+def transform_fused(x, out=None):
+    """Equivalent of pca.transform(scaler.transform(x)) without sklearn validation overhead"""
+    x_centered = (np.asarray(x, dtype=np.float32) - SCALER_MEAN) * SCALER_INV_SCALE - PCA_MEAN
+    return np.matmul(x_centered, PCA_WEIGHTS, out=out)
+
+# Only the centroids are needed at runtime, prefer the raw .npy saved alongside the kmeans model
+if os.path.exists(CFG.cluster_centers_path):
+    cluster_centers = np.load(CFG.cluster_centers_path, mmap_mode="r")
+else:
+    cluster_centers = load_model(CFG.cluster_model_path).cluster_centers_
+
+# Cluster centroids normalized once into probability distributions for JS divergence
+CENTROIDS_NORM = cluster_centers / cluster_centers.sum(axis=1, keepdims=True)
 
 appliance_labels = [
     "Microneedle_Array_1", "Blood_Chemistry_Analyzer", "pH_Sensor_Module", "Protein_Detector",
@@ -71,66 +138,52 @@ BIOMARKER_RANGES = {
     "chloride": {"normal": (98, 107), "abnormal": (85, 97)}  # mEq/L
 }
 
+PATIENT_CONDITIONS = ["normal", "early_ckd", "advanced_ckd", "esrd"]
+
+# Readings drawn per tick: electrolyte source followed by the extended panel,
+# urea and creatinine are derived from the albumin reading
+SENSOR_READINGS = ["sodium", *BIOMARKER_RANGES]
+NORMAL_LO, NORMAL_HI = np.array([BIOMARKER_RANGES[b]["normal"] for b in SENSOR_READINGS]).T
+ABNORMAL_LO, ABNORMAL_HI = np.array([BIOMARKER_RANGES[b]["abnormal"] for b in SENSOR_READINGS]).T
+
+rng = np.random.default_rng()
+
 # ---------- Azure IoT Hub Setup ----------
 device_client = None
 
 async def setup_azure_iot_client():
     global device_client
     try:
-        device_client = IoTHubDeviceClient.create_from_connection_string(AZURE_CONNECTION_STRING)
+        device_client = IoTHubDeviceClient.create_from_connection_string(CFG.azure_connection_string)
         await device_client.connect()
-        print(f"[Azure IoT] Connected to IoT Hub as device: {DEVICE_ID}")
+        print(f"[Azure IoT] Connected to IoT Hub as device: {CFG.device_id}")
         return device_client
     except (ConnectionFailedError, ConnectionDroppedError) as e:
         print(f"[Azure IoT] Connection failed: {e}")
         return None
 
 # ---------- Microneedle Sensor Simulation ----------
-def simulate_microneedle_sensor_reading(biomarker, patient_condition="normal"):
-    """
-    Simulates realistic microneedle sensor readings for various biomarkers
-    
-    Args:
-        biomarker: The biomarker to measure
-        patient_condition: "normal", "early_ckd", "advanced_ckd", "esrd"
-    """
-    base_noise = random.uniform(-SENSOR_CALIBRATION["noise_factor"], SENSOR_CALIBRATION["noise_factor"])
-    
-    if biomarker not in BIOMARKER_RANGES:
-        return 0.0
-    
-    if patient_condition == "normal":
-        min_val, max_val = BIOMARKER_RANGES[biomarker]["normal"]
-    else:
-        min_val, max_val = BIOMARKER_RANGES[biomarker]["abnormal"]
-    
-    # Add realistic sensor characteristics
-    reading = random.uniform(min_val, max_val)
-    reading *= (1 + base_noise)  # Add sensor noise
-    
-    return round(reading, 2)
-
 def get_comprehensive_blood_chemistry():
     """
     Simulates a comprehensive blood chemistry panel from microneedle array
     """
     # Determine patient condition randomly (in real system, this would be actual patient state)
-    conditions = ["normal", "early_ckd", "advanced_ckd", "esrd"]
-    patient_condition = random.choice(conditions)
+    patient_condition = random.choice(PATIENT_CONDITIONS)
     
-    # Primary kidney function markers
-    urea = simulate_microneedle_sensor_reading("albumin", patient_condition) * 15  # Convert to BUN equivalent
-    electrolyte = simulate_microneedle_sensor_reading("sodium", patient_condition) / 30  # Normalize to 3.5-6.0 range
-    creatinine = simulate_microneedle_sensor_reading("albumin", patient_condition) * 2  # Scale appropriately
+    # Draw every sensor reading of the panel at once
+    if patient_condition == "normal":
+        lo, hi = NORMAL_LO, NORMAL_HI
+    else:
+        lo, hi = ABNORMAL_LO, ABNORMAL_HI
+    noise_factor = SENSOR_CALIBRATION["noise_factor"]
+    readings = rng.uniform(lo, hi) * (1 + rng.uniform(-noise_factor, noise_factor, size=lo.shape))
+    (electrolyte_raw,
+     albumin, phosphorus, calcium, hemoglobin, blood_ph, sodium, chloride) = np.round(readings, 2).tolist()
     
-    # Additional biomarkers
-    albumin = simulate_microneedle_sensor_reading("albumin", patient_condition)
-    phosphorus = simulate_microneedle_sensor_reading("phosphorus", patient_condition)
-    calcium = simulate_microneedle_sensor_reading("calcium", patient_condition)
-    hemoglobin = simulate_microneedle_sensor_reading("hemoglobin", patient_condition)
-    blood_ph = simulate_microneedle_sensor_reading("blood_ph", patient_condition)
-    sodium = simulate_microneedle_sensor_reading("sodium", patient_condition)
-    chloride = simulate_microneedle_sensor_reading("chloride", patient_condition)
+    # Primary kidney function markers
+    urea = albumin * 15  # Convert to BUN equivalent
+    electrolyte = electrolyte_raw / 30  # Normalize to 3.5-6.0 range
+    creatinine = albumin * 2  # Scale appropriately
     
     # Calculate estimated GFR (eGFR) using simplified formula
     # eGFR = 186 × (creatinine/88.4)^-1.154 × (age)^-0.203 × (0.742 if female) × (1.210 if black)
@@ -158,10 +211,23 @@ def get_sensor_data_from_arduino():
     return blood_data["primary"]
 
 # ---------- Feature Calculation ----------
+@njit(cache=True)
 def calculate_features(urea, electrolyte, creatinine):
     clearance_rate = urea * electrolyte  # Urea clearance indicator
     dialysis_efficiency = clearance_rate * creatinine  # Overall dialysis efficiency
-    return [electrolyte, clearance_rate, dialysis_efficiency, urea, creatinine]
+    return (electrolyte, clearance_rate, dialysis_efficiency, urea, creatinine)
+
+@njit(cache=True)
+def _kidney_function_score(urea, creatinine, egfr, albumin):
+    # Weighted scoring based on clinical significance
+    urea_score = min(100.0, max(0.0, (100.0 - (urea - 20.0) * 2.0)))  # Lower is better
+    creatinine_score = min(100.0, max(0.0, (100.0 - (creatinine - 1.0) * 30.0)))  # Lower is better
+    egfr_score = min(100.0, max(0.0, egfr))  # Higher is better
+    albumin_score = min(100.0, max(0.0, albumin * 20.0))  # Higher is better
+    
+    # Composite kidney function score (0-100, higher is better)
+    return (urea_score * 0.25 + creatinine_score * 0.35 + 
+            egfr_score * 0.30 + albumin_score * 0.10)
 
 def calculate_kidney_function_score(blood_data):
     """
@@ -170,15 +236,8 @@ def calculate_kidney_function_score(blood_data):
     primary = blood_data["primary"]
     extended = blood_data["extended"]
     
-    # Weighted scoring based on clinical significance
-    urea_score = min(100, max(0, (100 - (primary[0] - 20) * 2)))  # Lower is better
-    creatinine_score = min(100, max(0, (100 - (primary[2] - 1) * 30)))  # Lower is better
-    egfr_score = min(100, max(0, extended["egfr"]))  # Higher is better
-    albumin_score = min(100, max(0, extended["albumin"] * 20))  # Higher is better
-    
-    # Composite kidney function score (0-100, higher is better)
-    kidney_score = (urea_score * 0.25 + creatinine_score * 0.35 + 
-                   egfr_score * 0.30 + albumin_score * 0.10)
+    kidney_score = _kidney_function_score(float(primary[0]), float(primary[2]),
+                                          float(extended["egfr"]), float(extended["albumin"]))
     
     return round(kidney_score, 1)
 
@@ -223,21 +282,20 @@ def get_ckd_stage(egfr):
         return "Stage 5 (Kidney failure)"
 
 # ---------- Send to Azure IoT Hub ----------
-async def send_data_to_azure(urea, electrolyte, creatinine, extended_data=None):
-    global device_client
-    if device_client is None:
-        print("[Azure IoT] Device client not connected")
-        return
-        
+def dumps_payload(payload):
+    """Serialize a message payload with orjson, numpy scalars and arrays included"""
+    return orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+def build_data_message(urea, electrolyte, creatinine, extended_data, timestamp):
     payload = {
-        "device_id": DEVICE_ID,
+        "device_id": CFG.device_id,
         "sensor_type": "microneedle_array",
         "primary_biomarkers": {
             "bun_level": round(urea, 2),
             "electrolyte_level": round(electrolyte, 2),
             "creatinine_level": round(creatinine, 2)
         },
-        "timestamp": int(time.time())
+        "timestamp": timestamp
     }
     
     # Add extended biomarker data if available
@@ -254,35 +312,35 @@ async def send_data_to_azure(urea, electrolyte, creatinine, extended_data=None):
         }
         payload["patient_condition"] = extended_data["patient_condition"]
     
-    try:
-        message = Message(json.dumps(payload))
-        message.custom_properties["messageType"] = MESSAGE_TOPIC
-        message.custom_properties["deviceType"] = "microneedle_sensor_array"
-        await device_client.send_message(message)
-        print(f"[Azure IoT] Published microneedle sensor data: Primary biomarkers sent")
-    except Exception as e:
-        print(f"[Azure IoT] Failed to send data: {e}")
+    message = Message(dumps_payload(payload))
+    message.custom_properties["messageType"] = CFG.message_property_topic
+    message.custom_properties["deviceType"] = "microneedle_sensor_array"
+    return message
+
+def build_kidney_assessment_message(assessment_data, timestamp):
+    assessment = {
+        "device_id": CFG.device_id,
+        "assessment_type": "kidney_function_analysis",
+        **assessment_data,
+        "timestamp": timestamp
+    }
+    message = Message(dumps_payload(assessment))
+    message.custom_properties["messageType"] = "kidney_assessment"
+    message.custom_properties["priority"] = "high" if assessment_data["risk_level"] in ["HIGH", "CRITICAL"] else "normal"
+    return message
 
-async def send_kidney_assessment_to_azure(assessment_data):
+async def send_messages_to_azure(messages):
+    """Publish a batch of messages concurrently over the single IoT Hub connection"""
     global device_client
     if device_client is None:
         print("[Azure IoT] Device client not connected")
         return
-        
+    
     try:
-        assessment = {
-            "device_id": DEVICE_ID,
-            "assessment_type": "kidney_function_analysis",
-            **assessment_data,
-            "timestamp": int(time.time())
-        }
-        message = Message(json.dumps(assessment))
-        message.custom_properties["messageType"] = "kidney_assessment"
-        message.custom_properties["priority"] = "high" if assessment_data["risk_level"] in ["HIGH", "CRITICAL"] else "normal"
-        await device_client.send_message(message)
-        print(f"[Azure IoT] Published kidney assessment: Risk Level {assessment_data['risk_level']}")
+        await asyncio.gather(*(device_client.send_message(message) for message in messages))
+        print(f"[Azure IoT] Published batch of {len(messages)} messages")
     except Exception as e:
-        print(f"[Azure IoT] Failed to send assessment: {e}")
+        print(f"[Azure IoT] Failed to send batch: {e}")
 
 async def send_alert_to_azure(alert_data):
     global device_client
@@ -295,18 +353,24 @@ async def send_alert_to_azure(alert_data):
             **alert_data,
             "timestamp": int(time.time())
         }
-        message = Message(json.dumps(alert))
-        message.custom_properties["messageType"] = ALERT_TOPIC
+        message = Message(dumps_payload(alert))
+        message.custom_properties["messageType"] = CFG.alert_property_topic
         await device_client.send_message(message)
         print(f"[Azure IoT Alert] Published alert: {alert}")
     except Exception as e:
         print(f"[Azure IoT] Failed to send alert: {e}")
 
 # ---------- Prediction ----------
+N_FEATURES = 5
+_features_np = np.empty((1, N_FEATURES), dtype=np.float32)  # Reused model input row
+
 def predict_and_print(features):
-    features_np = np.array([features])
-    #dt_pred = dt_model.predict(features_np)[0]
-    rf_pred = rf_model.predict(features_np)[0]
+    _features_np[0] = features
+    #dt_pred = dt_model.predict(_features_np)[0]
+    if rf_session is not None:
+        rf_pred = rf_session.run([RF_ONNX_LABEL], {RF_ONNX_INPUT: _features_np})[0][0]
+    else:
+        rf_pred = rf_model.predict(_features_np)[0]
 
     print("\n--- Microneedle Sensor Array Status ---")
     print("Sensor Modules:     ", "  ".join([label[:6] for label in appliance_labels]))
@@ -345,22 +409,23 @@ def display_comprehensive_results(blood_data, kidney_assessment):
     print("="*60)
 
 # ---------- Anomaly Detection ----------
+WINDOW_SIZE = 1
+_buffer_pca = np.empty((WINDOW_SIZE, PCA_WEIGHTS.shape[1]), dtype=np.float32)  # Reused PCA output buffer
+
 async def detect_anomaly(buffer, threshold=0.1, alert_percentage=0.5):
     try:
-        # Step 1: Scale the buffer using the loaded scaler
-        buffer_scaled = scaler.transform(buffer)
-
-        # Step 2: Apply PCA to reduce dimensionality
-        buffer_pca = pca.transform(buffer_scaled)
-
-        js_divergences = []
-        for sample in buffer_pca:
-            # Calculate the JS divergence between the point and all cluster centroids
-            distances = np.linalg.norm(kmeans.cluster_centers_ - sample, axis=1)
-            js_scores = [jensenshannon(sample, centroid) for centroid in kmeans.cluster_centers_]
-            js_divergences.append(np.min(js_scores))  # Taking the minimum JS score
+        # Step 1-2: Scale the buffer and apply PCA in one fused transform
+        buffer_pca = transform_fused(buffer, out=_buffer_pca[:len(buffer)])
+
+        # Step 3: JS divergence between every sample and every centroid in one broadcasted pass
+        samples_norm = buffer_pca / buffer_pca.sum(axis=1, keepdims=True)
+        p = samples_norm[:, None, :]
+        q = CENTROIDS_NORM[None, :, :]
+        m = 0.5 * (p + q)
+        js_scores = np.sqrt(0.5 * (rel_entr(p, m).sum(axis=-1) + rel_entr(q, m).sum(axis=-1)))
+        js_divergences = js_scores.min(axis=1)  # Taking the minimum JS score per sample
         
-        exceeded_threshold = sum([1 for js in js_divergences if js > threshold])
+        exceeded_threshold = int((js_divergences > threshold).sum())
         
         if exceeded_threshold / len(js_divergences) >= alert_percentage:
             alert_message = {
@@ -384,9 +449,8 @@ async def detect_anomaly(buffer, threshold=0.1, alert_percentage=0.5):
 def check_buffer(buffer, sample_counter, window_size):
     if sample_counter >= window_size:
         print("Microneedle sensor buffer collected:")
-        print(np.array(buffer))  # Printing the entire buffer of features
-        buffer.clear()  # Clears the buffer
-        sample_counter = 0  # Reset counter 
+        print(buffer)  # Printing the entire buffer of features
+        sample_counter = 0  # Reset counter, rows are overwritten in place on the next window
     return buffer, sample_counter
 
 # ---------- Main Loop ----------
@@ -394,9 +458,8 @@ async def main():
     # Setup Azure IoT Hub connection
     await setup_azure_iot_client()
     
-    buffer = []
+    buffer = np.empty((WINDOW_SIZE, N_FEATURES), dtype=np.float32)  # Fixed-size window of feature rows
     sample_counter = 0
-    WINDOW_SIZE = 1
     JS_threshold = 0.1
     alert_percentage = 0.5
     
@@ -415,18 +478,22 @@ async def main():
             kidney_assessment = assess_kidney_failure_risk(kidney_score, extended_data)
             
             # Legacy feature calculation for ML model compatibility
-            features = calculate_features(urea, electrolyte, creatinine)
+            features = calculate_features(float(urea), float(electrolyte), float(creatinine))
             
-            buffer.append(features)
+            buffer[sample_counter] = features
             sample_counter += 1
-            buffer, sample_counter = check_buffer(buffer, sample_counter, WINDOW_SIZE)
             
-            if len(buffer) == WINDOW_SIZE:  # Buffer is full, execute anomaly detection
+            if sample_counter == WINDOW_SIZE:  # Buffer is full, execute anomaly detection
                 await detect_anomaly(buffer, JS_threshold, alert_percentage)
+            buffer, sample_counter = check_buffer(buffer, sample_counter, WINDOW_SIZE)
 
-            # Send comprehensive data to Azure IoT Hub
-            await send_data_to_azure(urea, electrolyte, creatinine, extended_data)
-            await send_kidney_assessment_to_azure(kidney_assessment)
+            # Send comprehensive data to Azure IoT Hub as one batch per tick
+            timestamp = int(time.time())
+            batch = [
+                build_data_message(urea, electrolyte, creatinine, extended_data, timestamp),
+                build_kidney_assessment_message(kidney_assessment, timestamp)
+            ]
+            await send_messages_to_azure(batch)
             
             # Display comprehensive results
             display_comprehensive_results(blood_data, kidney_assessment)